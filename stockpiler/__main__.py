@@ -9,31 +9,34 @@ Requires Python 3.7 or higher.
 
 """
 
-from argparse import ArgumentParser, Namespace
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
 import getpass
 import importlib.resources
+import ipaddress
 from logging import getLogger
 import os
 import pathlib
 import sys
-from typing import Tuple
+from typing import Any, Callable, Dict, Tuple, TYPE_CHECKING
 
 
-from nornir import InitNornir
-from nornir.core import Nornir
-from nornir.core.inventory import ConnectionOptions
-from nornir.plugins.processors.print_result import PrintResult
-from nornir.plugins.tasks.networking import netmiko_send_command, netmiko_send_config
-from yaml import safe_load
-from yaml.constructor import ConstructorError
-
-
-from stockpiler.processors.process_stockpiles import ProcessStockpiles
-from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+# Our heavyweight dependencies (Nornir, Netmiko, GitPython, ruamel.yaml) are imported where they're used, so that
+#   `--help` and argument errors don't pay for importing them.
+if TYPE_CHECKING:
+    from nornir.core import Nornir
 
 
 logger = getLogger("stockpiler")
 
+# Resolve our packaged resources once, `importlib.resources.files` is only available on Python 3.9+,
+#   but we're not zip safe so the package directory itself is a fine fallback.
+try:
+    _PKG_ROOT = importlib.resources.files("stockpiler")
+except AttributeError:
+    _PKG_ROOT = pathlib.Path(__file__).parent
+_PKG_CONF = str(_PKG_ROOT / "nornir_conf.yaml")
+_PKG_SSH_CONFIG = str(_PKG_ROOT / "ssh_config")
+
 
 def main() -> None:
     """
@@ -43,6 +46,12 @@ def main() -> None:
     # Parse Arguments
     args = arg_parsing()
 
+    from nornir.plugins.processors.print_result import PrintResult
+    from nornir.plugins.tasks.networking import netmiko_send_command, netmiko_send_config
+
+    from stockpiler.processors.process_stockpiles import ProcessStockpiles
+    from stockpiler.tasks.stockpile.stockpile_base import stockpile_device_config
+
     # Begin Nornir setup
     norns = nornir_initialize(args=args)
 
@@ -65,7 +74,9 @@ def main() -> None:
             proxies = {"https": f"socks5://{args.proxy}", "http": f"socks5://{args.proxy}"}
         stockpile_directory = pathlib.Path(args.output or "/opt/stockpiler/")
 
-        stockpile_targets = filtered_norns.with_processors(processors=[ProcessStockpiles()])
+        stockpile_targets = filtered_norns.with_processors(
+            processors=[ProcessStockpiles(repack_every=args.repack_every)]
+        )
 
         # Executing stockpile of device configurations:
         stockpile_targets.run(task=stockpile_device_config, proxies=proxies, stockpile_directory=stockpile_directory)
@@ -92,6 +103,12 @@ def arg_parsing() -> Namespace:
     argparser.add_argument(
         "-o", "--output", type=str, help="Provide an output directory for our stockpile, default '/opt/stockpiler'"
     )
+    argparser.add_argument(
+        "--repack_every",
+        type=bounded_int_arg(minimum=0),
+        default=30,
+        help="Repack the output Git repository every N runs, 0 to leave it to Git's automatic gc, default 30.",
+    )
     argparser.add_argument("-p", "--proxy", type=str, help="'host:port' for a Socks Proxy to use for connectivity.")
     argparser.add_argument(
         "--prompt_for_credentials",
@@ -99,7 +116,15 @@ def arg_parsing() -> Namespace:
         help="Enable user prompt to provide custom credentials, otherwise will only try environment variables of"
         " STOCKPILER_USER and STOCKPILER_PW.",
     )
-    argparser.add_argument("-a", "--addresses", type=str, nargs="+", help="1 (or more) IP Address, space separated.")
+    argparser.add_argument(
+        "-w",
+        "--workers",
+        type=bounded_int_arg(minimum=1),
+        help="Number of devices to work on concurrently, default is from the config file (packaged default 100).",
+    )
+    argparser.add_argument(
+        "-a", "--addresses", type=ip_address_arg, nargs="+", help="1 (or more) IP Address, space separated."
+    )
     command_group = argparser.add_argument_group("command/config")
     command_group.add_argument("--command", type=str, help="1 command to execute on the selected devices.")
     command_group.add_argument(
@@ -124,26 +149,62 @@ def arg_parsing() -> Namespace:
     return argparser.parse_args()
 
 
-def nornir_initialize(args: Namespace) -> Nornir:
+def ip_address_arg(address: str) -> str:
+    """
+    Argparse type to validate an IP address and normalize it to its compressed form.
+    :param address: An IPv4/IPv6 address as given on the CLI
+    :return: The compressed string form of that IP address
+    """
+    try:
+        return ipaddress.ip_address(address).compressed
+    except ValueError:
+        raise ArgumentTypeError(f"{address} is not a valid IP address")
+
+
+def bounded_int_arg(minimum: int) -> Callable[[str], int]:
+    """
+    Build an Argparse type to validate an integer of `minimum` or more.
+    :param minimum: The smallest integer allowed
+    :return: An Argparse type function, returning the integer value
+    """
+
+    def int_arg(value: str) -> int:
+        try:
+            number = int(value)
+        except ValueError:
+            raise ArgumentTypeError(f"{value} is not a valid integer")
+        if number < minimum:
+            raise ArgumentTypeError(f"{value} must be {minimum} or greater")
+        return number
+
+    return int_arg
+
+
+def nornir_initialize(args: Namespace) -> "Nornir":
     """
     Given the parsed argument Namespace object, initialize a Nornir inventory/execution object and return it.
     :param args: A parsed/instantiated argpase.Namespace object with our command line arguments
     :return:
     """
 
-    log_file = pathlib.Path(pathlib.Path(args.logging_dir) / "stockpiler.log")
-    pathlib.Path(log_file).touch()
+    from nornir.core.inventory import ConnectionOptions
+
+    log_file = pathlib.Path(args.logging_dir) / "stockpiler.log"
+    log_file.touch()
 
     logging_config = {
         "level": args.log_level,
         "file": str(log_file),
         "loggers": ["nornir", "paramiko", "netmiko", "stockpiler"],
     }
-    if args.config_file:
-        config_file = args.config_file
-    else:
-        with importlib.resources.path(package="stockpiler", resource="nornir_conf.yaml") as p:
-            config_file = str(p)
+    config_file = args.config_file or _PKG_CONF
+
+    # Parse the config file once here, and hand Nornir the resulting dict rather than having it re-parse the file.
+    cf_path = pathlib.Path(config_file)
+    if not cf_path.is_file():
+        raise ValueError(f"The provided configuration file {str(cf_path)} is not found.")
+    # Don't litter the installed package directory with a cache of our packaged default config.
+    cf_yaml = load_config_file(cf_path=cf_path, use_cache=config_file != _PKG_CONF)
 
     # See if an SSH config file is specified in args or in the config file, order of precedence is:
     #   First In the inventory: Device -> Group -> Defaults
@@ -151,24 +212,20 @@ def nornir_initialize(args: Namespace) -> Nornir:
     if args.ssh_config_file:
         ssh_config_file = args.ssh_config_file
     else:
-        cf_path = pathlib.Path(config_file)
-        if not cf_path.is_file():
-            raise ValueError(f"The provided configuration file {str(cf_path)} is not found.")
-        with cf_path.open() as cf:
-            try:
-                cf_yaml = safe_load(cf)
-            except (ConstructorError, ValueError) as e:
-                raise ValueError(f"Unable to parse the provided config file {str(cf_path)} to YAML: {str(e)}")
         cf_ssh_config_file = cf_yaml.get("ssh", {}).get("config_file", None)
         if cf_ssh_config_file is not None:
             ssh_config_file = cf_ssh_config_file
         else:
-            with importlib.resources.path(package="stockpiler", resource="ssh_config") as p:
-                ssh_config_file = str(p)
+            ssh_config_file = _PKG_SSH_CONFIG
+
+    # Our settings override the config file, only override the worker count if asked to
+    overrides = {"logging": logging_config, "ssh": {"config_file": ssh_config_file}}
+    if args.workers is not None:
+        overrides["core"] = {"num_workers": args.workers}
 
     # Initialize our nornir object/inventory
-    logger.info("Reading config file and initializing inventory...")
-    norns = InitNornir(config_file=config_file, logging=logging_config, ssh={"config_file": ssh_config_file})
+    logger.info("Initializing inventory...")
+    norns = init_nornir_from_dict(config_settings=cf_yaml, **overrides)
 
     # Gather credentials:
     username, password, enable = gather_credentials(prompt_for_credentials=args.prompt_for_credentials)
@@ -183,6 +240,75 @@ def nornir_initialize(args: Namespace) -> Nornir:
     return norns
 
 
+def init_nornir_from_dict(config_settings: Dict[str, Any], **kwargs: Any) -> "Nornir":
+    """
+    Equivalent to `InitNornir(config_file=...)`, but from an already parsed config file.
+    The config file's settings are handed to Nornir the same way InitNornir does, so `NORNIR_*` environment variables
+    still take precedence over them, and the given kwargs take precedence over both.
+    :param config_settings: The parsed Nornir config file
+    :param kwargs: Per section settings overriding the config file, as would be passed to InitNornir
+    :return: An instantiated Nornir object
+    """
+
+    from nornir.core import Nornir
+    from nornir.core.deserializer.configuration import Config
+    from nornir.core.state import GlobalState
+    from nornir.init_nornir import register_default_connection_plugins
+
+    register_default_connection_plugins()
+
+    # Config.deserialize pops sections off of the settings it's given, so hand it a copy.
+    conf = Config.deserialize(__config_settings__=dict(config_settings), **kwargs)
+    if conf.logging.enabled is None:
+        conf.logging.enabled = True
+    conf.logging.configure()
+
+    inv = conf.inventory.plugin.deserialize(
+        transform_function=conf.inventory.transform_function,
+        transform_function_options=conf.inventory.transform_function_options,
+        config=conf,
+        **conf.inventory.options,
+    )
+
+    return Nornir(inventory=inv, config=conf, data=GlobalState(dry_run=False))
+
+
+def load_config_file(cf_path: pathlib.Path, use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Parse the given YAML config file, using a sibling `.cache.json` file if it was built from the same YAML content.
+    JSON parsing is much cheaper than YAML, so subsequent runs against an unchanged config skip YAML entirely.
+    :param cf_path: An instantiated pathlib.Path object of the YAML config file
+    :param use_cache: Set to False to always parse the YAML, and neither read nor write a cache file
+    :return: The parsed config file as a dict
+    """
+
+    from stockpiler.json_cache import hash_files, read_json_cache, write_json_cache
+
+    cache_path = pathlib.Path(f"{str(cf_path)}.cache.json")
+    # Key the cache on the YAML's content rather than mtimes, which deploy tools (`cp -p`, `rsync -a`) may preserve.
+    cf_hash = hash_files(str(cf_path)) if use_cache else ""
+    if use_cache:
+        cf_yaml = read_json_cache(cache_path=cache_path, source_hash=cf_hash)
+        if isinstance(cf_yaml, dict):
+            return cf_yaml
+
+    # Parse it the same way Nornir's Config.load_from_file does (YAML 1.2), so e.g. `yes` and `010` stay as they are.
+    import ruamel.yaml
+
+    with cf_path.open() as cf:
+        try:
+            cf_yaml = ruamel.yaml.YAML(typ="safe").load(cf) or {}
+        except (ruamel.yaml.YAMLError, ValueError) as e:
+            raise ValueError(f"Unable to parse the provided config file {str(cf_path)} to YAML: {str(e)}")
+
+    # The config may hold secrets (e.g. inventory plugin tokens), the cache is written readable only by us.
+    #   The config file may also live somewhere we can't write, that's OK.
+    if use_cache:
+        write_json_cache(cache_path=cache_path, source_hash=cf_hash, data=cf_yaml)
+
+    return cf_yaml
+
+
 def gather_credentials(prompt_for_credentials: bool = False) -> Tuple[str, str, str]:
     """
     Gather needed credentials for backing up these devices.
@@ -203,7 +329,7 @@ def gather_credentials(prompt_for_credentials: bool = False) -> Tuple[str, str,
     return username, password, enable
 
 
-def filtering(args: Namespace, norns: Nornir) -> Nornir:
+def filtering(args: Namespace, norns: "Nornir") -> "Nornir":
     """
     Provide inventory filtering based on attributes from args.
 
@@ -214,10 +340,16 @@ def filtering(args: Namespace, norns: Nornir) -> Nornir:
 
     print("Filtering Target Hosts")
 
+    addr_set = frozenset(args.addresses or [])
+
     def is_cli_selected_host(host):
-        return host.data["ip"] in args.addresses
+        # Normalize the inventory address the same way as the CLI ones, so e.g. uncompressed IPv6 still matches.
+        try:
+            return ipaddress.ip_address(host.data["ip"]).compressed in addr_set
+        except ValueError:
+            return host.data["ip"] in addr_set
 
-    if args.addresses:
+    if addr_set:
         return norns.filter(filter_func=is_cli_selected_host)
     else:
         return norns
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Nornir SimpleInventory, with the parsed YAML inventory cached to JSON.
+
+Large inventories are slow to parse via YAML on every run, so we keep a sidecar JSON copy of the parsed inventory
+ keyed on a hash of the inventory files, and only parse the YAML again when those change.
+"""
+
+from logging import getLogger
+import os
+import pathlib
+from typing import Any, Dict, Optional
+
+from nornir.plugins.inventory.simple import SimpleInventory
+import ruamel.yaml
+
+from stockpiler.json_cache import hash_files, read_json_cache, write_json_cache
+
+
+logger = getLogger("stockpiler")
+
+
+class CachedSimpleInventory(SimpleInventory):
+    def __init__(
+        self,
+        host_file: str = "hosts.yaml",
+        group_file: str = "groups.yaml",
+        defaults_file: str = "defaults.yaml",
+        cache_file: Optional[str] = None,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Load our inventory from the JSON cache if it matches the inventory files, otherwise parse the YAML the same
+        way SimpleInventory does and write a fresh cache.  Either way, SimpleInventory is handed the parsed dicts.
+        :param host_file: Path to the hosts inventory file
+        :param group_file: Path to the groups inventory file
+        :param defaults_file: Path to the defaults inventory file
+        :param cache_file: Path to the JSON cache, default is `inventory.cache.json` alongside the host_file
+        :param kwargs: Passed on to SimpleInventory
+        """
+
+        # Expand `~` in our paths the same way SimpleInventory does
+        host_file, group_file, defaults_file, cache_file = (
+            os.path.expanduser(f) if f else f for f in (host_file, group_file, defaults_file, cache_file)
+        )
+
+        cache_path = pathlib.Path(cache_file or pathlib.Path(host_file).parent / "inventory.cache.json")
+        inventory_hash = hash_files(host_file, group_file, defaults_file)
+
+        inventory = read_json_cache(cache_path=cache_path, source_hash=inventory_hash)
+        if not isinstance(inventory, dict):
+            yml = ruamel.yaml.YAML(typ="safe")
+            with open(host_file, "r") as f:
+                hosts = yml.load(f)
+            inventory = {
+                "hosts": hosts,
+                "groups": self.load_optional_yaml(yml=yml, yaml_file=group_file),
+                "defaults": self.load_optional_yaml(yml=yml, yaml_file=defaults_file),
+            }
+            write_json_cache(cache_path=cache_path, source_hash=inventory_hash, data=inventory)
+
+        super().__init__(
+            host_file=host_file,
+            group_file=group_file,
+            defaults_file=defaults_file,
+            hosts=inventory["hosts"],
+            groups=inventory["groups"],
+            defaults=inventory["defaults"],
+            **kwargs,
+        )
+
+    @staticmethod
+    def load_optional_yaml(yml: ruamel.yaml.YAML, yaml_file: Optional[str]) -> Dict[str, Any]:
+        """
+        Parse an inventory file that's allowed to be missing, as SimpleInventory does for groups and defaults.
+        :param yml: An instantiated ruamel.yaml.YAML loader
+        :param yaml_file: Path to the inventory file, if any
+        :return: The parsed file, or an empty dict if it doesn't exist
+        """
+
+        if not yaml_file or not pathlib.Path(yaml_file).exists():
+            return {}
+        with open(yaml_file, "r") as f:
+            return yml.load(f) or {}
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Sidecar JSON caches of parsed YAML files, used for both our config file and inventory.
+
+JSON is much cheaper to parse than YAML, so we keep a JSON copy of the parsed data keyed on a hash of the YAML files
+ it came from, and only parse the YAML again when those change.
+"""
+
+import hashlib
+from logging import getLogger
+import os
+import pathlib
+from typing import Any, Optional
+
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    import json
+
+    _json_loads = json.loads
+
+    def _json_dumps(data: Any) -> bytes:
+        return json.dumps(data).encode()
+
+
+logger = getLogger("stockpiler")
+
+
+def hash_files(*source_files: Optional[str]) -> str:
+    """
+    Hash the contents of the files a cache is built from, missing files (e.g. no defaults file) are treated as empty.
+    :param source_files: Paths of the source files
+    :return: A hex sha256 digest of the files' contents
+    """
+
+    source_hash = hashlib.sha256()
+    for source_file in source_files:
+        try:
+            source_hash.update(pathlib.Path(source_file).read_bytes())
+        except (OSError, TypeError):
+            pass
+        source_hash.update(b"\0")
+
+    return source_hash.hexdigest()
+
+
+def read_json_cache(cache_path: pathlib.Path, source_hash: str) -> Optional[Any]:
+    """
+    Read a JSON cache, if it was built from the current source files.
+    :param cache_path: An instantiated pathlib.Path object of the JSON cache
+    :param source_hash: Hash of the current source files, from hash_files()
+    :return: The cached data, or None if it's missing or stale
+    """
+
+    try:
+        cache = _json_loads(cache_path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(cache, dict) or cache.get("hash") != source_hash:
+        return None
+
+    logger.debug("Loading from cache %s", str(cache_path))
+    return cache.get("data")
+
+
+def write_json_cache(cache_path: pathlib.Path, source_hash: str, data: Any) -> None:
+    """
+    Write freshly parsed data to a JSON cache, readable only by us as it may contain credentials.
+    The data is only cached if it survives a round trip through JSON unchanged (JSON only has string keys, no dates,
+    etc.), so a cached run never sees different data than a parsed one.
+    Failures are logged and otherwise ignored, we'll simply parse the YAML again next time.
+    :param cache_path: An instantiated pathlib.Path object of the JSON cache
+    :param source_hash: Hash of the source files the data was parsed from, from hash_files()
+    :param data: The parsed data to cache
+    :return:
+    """
+
+    try:
+        cache = _json_dumps({"hash": source_hash, "data": data})
+        if _json_loads(cache)["data"] != data:
+            raise TypeError("data does not round trip through JSON unchanged")
+        fd = os.open(str(cache_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as cache_file:
+            cache_path.chmod(0o600)  # In case the cache already existed with other permissions
+            cache_file.write(cache)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug("Unable to write cache %s: %s", str(cache_path), str(e))
@@ -9,11 +9,13 @@ See https://nornir.readthedocs.io/en/latest/tutorials/intro/processors.html for
 import csv
 import datetime
 import logging
+import os
 import pathlib
+import tempfile
 import threading
 
 
-from git import Actor, Repo
+from git import Repo
 from nornir.core.inventory import Host
 from nornir.core.processor import Processor
 from nornir.core.task import AggregatedResult, MultiResult, Task
@@ -23,13 +25,15 @@ logger = logging.getLogger("stockpiler")
 
 
 class ProcessStockpiles(Processor):
-    def __init__(self, **kwargs) -> None:
+    def __init__(self, repack_every: int = 0, **kwargs) -> None:
         """
         Initialize some base values for this processor
+        :param repack_every: Explicitly repack the stockpile Git repository every N runs, 0 to never repack
         :param kwargs:
         """
 
-        self.task_start_time = datetime.datetime.utcnow()
+        self.task_start_time = datetime.datetime.now(datetime.timezone.utc)
+        self.repack_every = repack_every
         self.lock = threading.Lock()
         super().__init__(**kwargs)
 
@@ -48,7 +52,8 @@ class ProcessStockpiles(Processor):
             1) Print finish time and calculate run time
             2) Initialize our Git repository
             3) Write a CSV report on this backup task
-            4) Add all written files to this commit, and commit it
+            4) Add the CSV and each successfully stockpiled config to this commit, and commit it
+            5) Repack the Git repository, if we're due to
         :param task:
         :param result:
         :return:
@@ -56,33 +61,62 @@ class ProcessStockpiles(Processor):
 
         # Process our results into a CSV and write it to the stockpile output directory.
 
-        task_end_time = datetime.datetime.utcnow()
+        task_end_time = datetime.datetime.now(datetime.timezone.utc)
         print(f"Backup Task End Time: {task_end_time.isoformat()}")
         print(f"Backup Task Elapsed Time: {task_end_time - self.task_start_time}")
 
         # Plumb up Git repository
-        repo = self.git_initialize(stockpile_directory=task.params["stockpile_directory"])
-        author = Actor(name="Stockpiler", email="stockpiler@localhost.local")
+        repo = self.git_initialize(
+            stockpile_directory=task.params["stockpile_directory"], repack_every=self.repack_every
+        )
 
         csv_out = pathlib.Path(f"{task.params['stockpile_directory']}/results.csv")
         print(f"Putting results into a CSV at {csv_out}")
-        with csv_out.open(mode="w") as output_file:
-            fieldnames = [i for i in next(result[x] for x in result)[0].result.keys() if i not in ["device_config"]]
+        # Track exactly what we've written, so Git doesn't need to rescan the whole stockpile.
+        #   These are relative to the repository root, as git runs from within the stockpile directory.
+        written = ["results.csv"]
+        with csv_out.open(mode="w", buffering=1 << 20, newline="") as output_file:
+            fieldnames = tuple(
+                i for i in next(result[x] for x in result)[0].result.keys() if i not in ["device_config"]
+            )
 
-            writer = csv.DictWriter(output_file, fieldnames=fieldnames)
+            writer = csv.writer(output_file)
 
-            writer.writeheader()
+            writer.writerow(fieldnames)
             for host in result.keys():
                 # Don't try to write this if it's not a dict.
                 if not isinstance(result[host][0].result, dict):
                     continue
-                writer.writerow({k: v for (k, v) in result[host][0].result.items() if k not in ["device_config"]})
+                row = result[host][0].result
+                writer.writerow([row.get(k, "") for k in fieldnames])
+                if row.get("backup_successful"):
+                    written.append(f"{host}.txt")
+
+            # Sync once after all rows are written, fdatasync isn't available on all platforms (e.g. Windows)
+            output_file.flush()
+            getattr(os, "fdatasync", os.fsync)(output_file.fileno())
+
+        # Git Commit the changed/stockpiled files, via the git CLI so the tree is built by git itself
+        #   rather than by walking the entire index in Python.
+        with repo.git.custom_environment(
+            GIT_AUTHOR_NAME="Stockpiler",
+            GIT_AUTHOR_EMAIL="stockpiler@localhost.local",
+            GIT_COMMITTER_NAME="Stockpiler",
+            GIT_COMMITTER_EMAIL="stockpiler@localhost.local",
+            GIT_LITERAL_PATHSPECS="1",  # Host names are file names, not globs
+        ), tempfile.TemporaryFile() as pathspecs:
+            # Hand git our file list on stdin, a large fleet won't fit on one command line (especially on Windows).
+            pathspecs.write(b"\0".join(os.fsencode(path) for path in written))
+            pathspecs.seek(0)
+            repo.git.add("--pathspec-from-file=-", "--pathspec-file-nul", istream=pathspecs)
+            # We run unattended, so don't run any repo hooks or try to GPG sign (and potentially prompt) either.
+            repo.git.commit(
+                "--no-verify", "--no-gpg-sign", message=f"Stockpile Built at {task_end_time.isoformat()}"
+            )
 
-        # Git Commit the changed/stockpiled files
-        repo.git.add(
-            all=True
-        )  # Should be changed to explicitly add all filenames from the results... but that's harder
-        repo.index.commit(message=f"Stockpile Built at {datetime.datetime.utcnow().isoformat()}", author=author)
+        # Automatic gc is disabled on the stockpile when we repack, so pack it up ourselves periodically
+        if self.repack_every:
+            self.git_repack(repo=repo, repack_every=self.repack_every)
 
     def task_instance_started(self, task: Task, host: Host) -> None:
         pass  # This is required for implementation, but at this time we're taking no action here
@@ -107,30 +141,67 @@ class ProcessStockpiles(Processor):
 
     # Helper functions, not core to Nornir internals of handling task stages.
     @staticmethod
-    def git_initialize(stockpile_directory: pathlib.Path) -> Repo:
+    def git_initialize(stockpile_directory: pathlib.Path, repack_every: int = 0) -> Repo:
         """
         Given a directory we're going to stash backups/stockpile into, either initialize it,
         or ensure it is ready for stockpiling.
         Then return an initialized Git Repo object
         :param stockpile_directory: An instantiated pathlib.Path object where we want the stockpile to go
+        :param repack_every: How many runs between each explicit repack, 0 if we never repack ourselves
         :return: An instantiated git.Repo object where we want backups to go
         """
 
+        stockpile_directory_str = str(stockpile_directory)
+        git_directory = stockpile_directory / ".git"
+
         # Ensure this path exists, and create it if not
         if not stockpile_directory.is_dir():
-            logger.info("%s does not exist, creating it", str(stockpile_directory))
+            logger.info("%s does not exist, creating it", stockpile_directory_str)
             stockpile_directory.mkdir(parents=True)
 
         # Check if there's already a git repo there, create one if not
-        if not pathlib.Path(stockpile_directory / ".git").is_dir():
+        if not git_directory.is_dir():
             logger.info(
-                "%s exists, but does not appear to be a git repository, creating one there", str(stockpile_directory)
+                "%s exists, but does not appear to be a git repository, creating one there", stockpile_directory_str
             )
-            repo = Repo.init(path=str(stockpile_directory))
+            repo = Repo.init(path=stockpile_directory_str)
 
         # Since the path exists, it has a `.git` dir, instantiate a repo object on that
         else:
-            logger.info("%s exists, reading repository", str(pathlib.Path(stockpile_directory / ".git")))
-            repo = Repo(path=str(stockpile_directory))
+            logger.info("%s exists, reading repository", str(git_directory))
+            repo = Repo(path=stockpile_directory_str)
+
+        # If we repack explicitly every so many runs, don't let every commit trigger `git gc --auto` as well.
+        #   Otherwise leave git's auto gc be, undoing our setting from any earlier runs that did repack.
+        #   Only write the config if needed, rather than rewriting `.git/config` on every run.
+        gc_auto = str(repo.config_reader(config_level="repository").get_value("gc", "auto", default=""))
+        if repack_every and gc_auto != "0":
+            with repo.config_writer() as config:
+                config.set_value("gc", "auto", "0")
+        elif not repack_every and gc_auto == "0":
+            with repo.config_writer() as config:
+                config.remove_option("gc", "auto")
 
         return repo
+
+    @staticmethod
+    def git_repack(repo: Repo, repack_every: int) -> None:
+        """
+        Count stockpile runs in a file within the `.git` directory, and repack the repository every `repack_every` runs.
+        :param repo: An instantiated git.Repo object of our stockpile
+        :param repack_every: How many runs between each repack
+        :return:
+        """
+
+        runs_file = pathlib.Path(repo.git_dir) / "stockpiler_runs"
+        try:
+            runs = int(runs_file.read_text()) + 1
+        except (OSError, ValueError):
+            runs = 1
+
+        if runs >= repack_every:
+            logger.info("Repacking %s after %s runs", repo.working_tree_dir, runs)
+            repo.git.repack("-A", "-d")
+            runs = 0
+
+        runs_file.write_text(str(runs))
@@ -5,16 +5,21 @@ Backup tasks for Cisco devices
 """
 
 
+import datetime
+from functools import lru_cache
 import ipaddress
 from logging import getLogger
 import pathlib
+import re
+from typing import AnyStr
 from urllib.parse import quote_plus
 
 
 from nornir.core.task import Result, Task
-from nornir.plugins.tasks import files
 from nornir.plugins.tasks.apis import http_method
 from nornir.plugins.tasks.networking import netmiko_save_config, netmiko_send_command, tcp_ping
+import requests
+import urllib3
 
 
 from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
@@ -22,6 +27,40 @@ from stockpiler.tasks.stockpile.stockpile_results import StockpileResults
 
 logger = getLogger("stockpiler")
 
+# Case-insensitive checks for authorization failures.  IGNORECASE patterns lose re's fast literal search, so we only
+#   search the tail of each response, an authorization failure is a short response anyway.
+_AUTH_FAILED = re.compile("command authorization failed", re.IGNORECASE)
+_AUTH_FAILED_BYTES = re.compile(rb"command authorization failed", re.IGNORECASE)
+_AUTH_FAILED_TAIL = 256
+
+# We don't verify TLS when connecting to devices by IP address, disable those warnings once rather than per host.
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+def _auth_failed(output: AnyStr) -> bool:
+    """
+    Determine if a device's response is a command authorization failure
+    :param output: The response from the device, as str (SSH) or bytes (HTTPS)
+    :return: True if the tail of the response reports a command authorization failure
+    """
+    tail = output[-_AUTH_FAILED_TAIL:]
+    pattern = _AUTH_FAILED_BYTES if isinstance(tail, bytes) else _AUTH_FAILED
+    return pattern.search(tail) is not None
+
+
+@lru_cache(maxsize=None)
+def _is_ip(hostname: str) -> bool:
+    """
+    Determine if a given hostname is an IP address
+    :param hostname: The hostname (or IP address) of a device
+    :return: True if hostname is an IPv4/IPv6 address
+    """
+    try:
+        ipaddress.ip_address(hostname)
+    except ValueError:
+        return False
+    return True
+
 
 def stockpile_cisco_generic(
     task: Task, stockpile_directory: pathlib.Path, backup_command: str = "more system:running-config"
@@ -38,11 +77,13 @@ def stockpile_cisco_generic(
     """
 
     # Dict-like object of our eventual return info
+    now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
     stockpile_info = StockpileResults(
         name=f"{task.host}_backup",
         ip=task.host.hostname,
         hostname=task.host.get("device_name", task.host),
-        ssh_mgmt_port=task.host.get("port", 22) or 22,  # Need `or` statement as we're getting None from inventory
+        ssh_mgmt_port=task.host.get("port") or 22,  # Need `or` statement as we can get None from inventory
+        last_backup_attempt=now_iso,
     )
 
     # Validate SSH TCP port:
@@ -64,25 +105,23 @@ def stockpile_cisco_generic(
 
     # Gather a backup:
     backup_results = task.run(task=netmiko_send_command, command_string=backup_command)
-    if not backup_results[0].failed and "command authorization failed" not in backup_results[0].result.lower():
+    if not backup_results[0].failed and not _auth_failed(backup_results[0].result):
         stockpile_info["device_config"] = backup_results[0].result
         stockpile_info["backup_successful"] = True
+        stockpile_info["last_successful_backup"] = now_iso
         stockpile_info["ssh_used"] = True
         logger.debug("Successfully backed up %s", task.host)
 
     # Save the config on the box:
     save_config_results = task.run(task=netmiko_save_config)
-    if (
-        not save_config_results[0].failed
-        and "command authorization failed" not in save_config_results[0].result.lower()
-    ):
+    if not save_config_results[0].failed and not _auth_failed(save_config_results[0].result):
         stockpile_info["save_config_successful"] = True
         logger.debug("Successfully saved configuration on %s", task.host)
 
-    # Attempt to save the backup if we have one
+    # Attempt to save the backup if we have one, Git tracks the changes so there's no need to diff it here.
     if stockpile_info["backup_successful"]:
-        file_name = pathlib.Path(stockpile_directory / f"{str(task.host)}.txt")
-        task.run(task=files.write_file, filename=str(file_name), content=stockpile_info["device_config"])
+        file_name = stockpile_directory / f"{str(task.host)}.txt"
+        file_name.write_text(stockpile_info["device_config"])
     else:
         logger.error("Failed to backup %s", task.host)
 
@@ -107,27 +146,29 @@ def stockpile_cisco_asa(
     """
 
     # Dict-like object of our eventual return info
+    now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
     stockpile_info = StockpileResults(
         name=f"{task.host}_backup",
         ip=task.host.hostname,
         hostname=task.host.get("device_name", task.host),
         http_management=task.host.get("http_management", False),
         http_mgmt_port=task.host.get("http_mgmt_port", 8443),
-        ssh_mgmt_port=task.host.get("port", 22) or 22,  # Need `or` statement as we're getting None from inventory
+        ssh_mgmt_port=task.host.get("port") or 22,  # Need `or` statement as we can get None from inventory
+        last_backup_attempt=now_iso,
     )
 
+    # Always validate SSH TCP port, in case we need it (as fallback) or if HTTP mgmt disabled.
     # Check if we are using HTTP and if we can hit TCP port; skip if proxies, the TCP check won't do us any good.
-    if stockpile_info["http_management"] and proxies is not None:
-        stockpile_info["http_port_check_ok"] = True
-    elif stockpile_info["http_management"]:
-        stockpile_info["http_port_check_ok"] = task.run(
-            task=tcp_ping, ports=[stockpile_info["http_mgmt_port"]], timeout=1
-        ).result[stockpile_info["http_mgmt_port"]]
-
-    # Validate SSH TCP port, in case we need it (as fallback) or if HTTP mgmt disabled:
-    stockpile_info["ssh_port_check_ok"] = task.run(
-        task=tcp_ping, ports=[stockpile_info["ssh_mgmt_port"]], timeout=1
-    ).result[stockpile_info["ssh_mgmt_port"]]
+    # All ports are checked in a single tcp_ping subtask to save a task dispatch, tcp_ping still tries each port
+    #   in turn, so unreachable ports each cost a full timeout.
+    ports = [stockpile_info["ssh_mgmt_port"]]
+    if stockpile_info["http_management"] and proxies is None:
+        ports.append(stockpile_info["http_mgmt_port"])
+    ping = task.run(task=tcp_ping, ports=ports, timeout=1).result
+
+    stockpile_info["ssh_port_check_ok"] = ping[stockpile_info["ssh_mgmt_port"]]
+    if stockpile_info["http_management"]:
+        stockpile_info["http_port_check_ok"] = proxies is not None or ping[stockpile_info["http_mgmt_port"]]
 
     # If we can't hit either port, what are we doing here?  GET TO THE CHOPPA!
     if not stockpile_info["http_port_check_ok"] and not stockpile_info["ssh_port_check_ok"]:
@@ -145,45 +186,61 @@ def stockpile_cisco_asa(
     if stockpile_info["http_port_check_ok"]:
         logger.debug("Attempting to backup %s:%s via HTTPS", task.host, stockpile_info["http_mgmt_port"])
 
-        # Disable TLS warnings if task.host.hostname is an IP address:
-        try:
-            _ = ipaddress.ip_address(task.host.hostname)
-            import urllib3
-
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-            verify = False
-        except ValueError:
-            verify = True
+        # Don't verify TLS if task.host.hostname is an IP address:
+        verify = not _is_ip(task.host.hostname)
 
         # Setup Requests options/payload
         url = f"https://{task.host.hostname}:{stockpile_info['http_mgmt_port']}/admin/exec/"
         asa_http_kwargs = {
-            "method": "GET",
             "auth": (task.host.username, task.host.password),
             "headers": {"User-Agent": "ASDM"},
             "verify": verify,
             "proxies": proxies,
         }
 
-        # Gather a backup:
-        backup_results = task.run(task=http_method, url=url + quote_plus(backup_command), **asa_http_kwargs)
-        if (
-            backup_results[0].response.ok
-            and "command authorization failed" not in backup_results[0].response.text.lower()
-        ):
-            stockpile_info["device_config"] = backup_results[0].response.text
+        # Gather a backup, streaming it to disk as it arrives rather than holding the whole config in memory.
+        #   This goes to a temporary file first, so a failed attempt won't clobber our last good stockpile.
+        file_name = stockpile_directory / f"{str(task.host)}.txt"
+        tmp_file_name = stockpile_directory / f"{str(task.host)}.txt.tmp"
+        backup_ok = False
+        tail = b""
+        try:
+            with requests.get(
+                url + quote_plus(backup_command), stream=True, **asa_http_kwargs
+            ) as response, tmp_file_name.open(mode="wb") as tmp_file:
+                backup_ok = response.ok
+                for chunk in response.iter_content(chunk_size=65536):
+                    tmp_file.write(chunk)
+                    # Keep a rolling tail, an error message may be split across (chunked encoding) chunks.
+                    tail = (tail + chunk)[-_AUTH_FAILED_TAIL:]
+        except (requests.exceptions.RequestException, OSError) as e:
+            backup_ok = False
+            logger.error("Error gathering backup of %s via HTTPS: %s", task.host, str(e))
+
+        if backup_ok and not _auth_failed(tail):
+            tmp_file_name.replace(file_name)
             stockpile_info["backup_successful"] = True
+            stockpile_info["last_successful_backup"] = now_iso
             stockpile_info["http_used"] = True
             logger.debug("Successfully backed up %s", task.host)
 
-        # Save the config on the box:
-        wr_mem_results = task.run(task=http_method, url=url + quote_plus("write mem"), **asa_http_kwargs)
-        if (
-            wr_mem_results[0].response.ok
-            and "command authorization failed" not in backup_results[0].response.text.lower()
-        ):
-            stockpile_info["save_config_successful"] = True
-            logger.debug("Successfully saved configuration on %s", task.host)
+            # Save the config on the box, only once HTTPS has worked, as http_method raises on connection errors
+            #   and we'd never get to fall back to SSH.
+            wr_mem_results = task.run(
+                task=http_method,
+                method="GET",
+                url=url + quote_plus("write mem"),
+                raise_for_status=False,
+                **asa_http_kwargs,
+            )
+            if wr_mem_results[0].response.ok and not _auth_failed(wr_mem_results[0].response.content):
+                stockpile_info["save_config_successful"] = True
+                logger.debug("Successfully saved configuration on %s", task.host)
+        else:
+            try:
+                tmp_file_name.unlink()
+            except FileNotFoundError:
+                pass
 
     # Attempt backup via SSH, if HTTPS fails or HTTPS management was not enabled.
     if not stockpile_info["backup_successful"] and stockpile_info["ssh_port_check_ok"]:
@@ -191,23 +248,25 @@ def stockpile_cisco_asa(
 
         # Gather a backup:
         backup_results = task.run(task=netmiko_send_command, command_string=backup_command)
-        if not backup_results[0].failed and "command authorization failed" not in backup_results[0].result.lower():
+        if not backup_results[0].failed and not _auth_failed(backup_results[0].result):
             stockpile_info["device_config"] = backup_results[0].result
             stockpile_info["backup_successful"] = True
+            stockpile_info["last_successful_backup"] = now_iso
             stockpile_info["ssh_used"] = True
             logger.debug("Successfully backed up %s", task.host)
 
-        # Save the config on the box:
-        wr_mem_results = task.run(task=netmiko_save_config)
-        if not wr_mem_results[0].failed and "command authorization failed" not in wr_mem_results[0].result.lower():
-            stockpile_info["save_config_successful"] = True
-            logger.debug("Successfully saved configuration on %s", task.host)
-
-    # Attempt to save the backup if we have one
-    if stockpile_info["backup_successful"]:
-        file_name = pathlib.Path(stockpile_directory / f"{str(task.host)}.txt")
-        task.run(task=files.write_file, filename=str(file_name), content=stockpile_info["device_config"])
-    else:
+        # Save the config on the box, unless we've already done so via HTTPS:
+        if not stockpile_info["save_config_successful"]:
+            wr_mem_results = task.run(task=netmiko_save_config)
+            if not wr_mem_results[0].failed and not _auth_failed(wr_mem_results[0].result):
+                stockpile_info["save_config_successful"] = True
+                logger.debug("Successfully saved configuration on %s", task.host)
+
+    # Attempt to save the backup if we have one, HTTPS backups have already been streamed to disk.
+    if stockpile_info["ssh_used"]:
+        file_name = stockpile_directory / f"{str(task.host)}.txt"
+        file_name.write_text(stockpile_info["device_config"])
+    elif not stockpile_info["backup_successful"]:
         # If we've failed both backup attempts, log that.
         logger.error("Failed to backup %s via HTTPS or SSH", task.host)
 
@@ -4,7 +4,7 @@
 Base stockpile results object
 """
 
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Dict, Optional, Union
 
 
@@ -25,12 +25,15 @@ class StockpileResults(Dict[str, Union[bool, int, str]]):
         "save_config_successful": True,
         "http_used": True,
         "ssh_used": False,
-        "last_backup_attempt": 2020-01-25T13:25:53.540015,
+        "last_backup_attempt": "2020-01-25T13:25:53.540015+00:00",
         "last_successful_backup": None,
         "device_config": None,
     }
     """
 
+    # We hold one of these per device, don't give each its own attribute `__dict__` on top of the dict itself.
+    __slots__ = ("name",)
+
     def __init__(
         self,
         name: str,
@@ -45,8 +48,8 @@ class StockpileResults(Dict[str, Union[bool, int, str]]):
         save_config_successful: bool = False,
         http_used: bool = False,
         ssh_used: bool = False,
-        last_backup_attempt: str = datetime.utcnow().isoformat(),
-        last_successful_backup: Optional[datetime] = None,
+        last_backup_attempt: Optional[str] = None,
+        last_successful_backup: Optional[str] = None,
         device_config: Optional[str] = None,
         **kwargs: Union[bool, int, str],
     ) -> None:
@@ -64,12 +67,14 @@ class StockpileResults(Dict[str, Union[bool, int, str]]):
         :param save_config_successful: Was saving the config successful?
         :param http_used: Did we use HTTP in this backup attempt?
         :param ssh_used: Did we use SSH in this backup attempt?
-        :param last_backup_attempt: When did we attempt this backup?
+        :param last_backup_attempt: When did we attempt this backup? (Default now, in UTC)
         :param last_successful_backup: When was the last successful backup?
         :param device_config: The device configuration we gathered (if any)
         :param **kwargs: Any other outstanding items you need in this results Dict
         """
         self.name = name
+        if last_backup_attempt is None:
+            last_backup_attempt = datetime.now(timezone.utc).isoformat()
 
         # Pass on all of our arguments to the underlying dict creation
         arguments = {k: v for (k, v) in locals().items() if k not in ["self", "__class__", "kwargs", "name"]}